@@ -0,0 +1,19 @@
+import logging.config
+
+# Incremental: the LiveKit CLI owns the handlers (console formatting and IPC
+# forwarding from job processes), so only levels are set here and records keep
+# propagating to those handlers.
+LOGGING_CONFIG = {
+    "version": 1,
+    "incremental": True,
+    "loggers": {
+        "mike-voice-agent": {
+            "level": "DEBUG",
+        },
+    },
+}
+
+
+def configure() -> None:
+    """Apply the agent's logger levels without touching installed handlers."""
+    logging.config.dictConfig(LOGGING_CONFIG)
@@ -8,28 +8,65 @@ tags: [education, multilingual, livekit, voice-agent]
 
 import logging
 import os
-import json
+import sys
+import orjson
 import base64
 import asyncio
+from contextvars import ContextVar
+from dataclasses import dataclass
 from dotenv import load_dotenv
-from livekit.agents import JobContext, WorkerOptions, cli, RoomInputOptions, metrics
+from livekit.agents import JobContext, JobProcess, WorkerOptions, cli, RoomInputOptions, metrics
 from livekit.agents.voice import Agent, AgentSession, MetricsCollectedEvent
-from livekit.plugins import openai, silero, deepgram, elevenlabs, google, noise_cancellation
+from livekit.plugins import google, noise_cancellation
 from livekit.agents.telemetry import set_tracer_provider
 from livekit import rtc
 
-from opentelemetry.sdk.trace import TracerProvider
+import logging_setup
+
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace import Span, SpanProcessor, TracerProvider
 from opentelemetry.util.types import AttributeValue
 
+if sys.platform != "win32":
+    import uvloop
+
+    # Job processes re-import this module, so they pick up the libuv loop too
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 load_dotenv('.env')
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
 logger = logging.getLogger("mike-voice-agent")
-logger.setLevel(logging.DEBUG)
+
+# Per-job Langfuse attributes; the tracer provider itself is shared by the process.
+_session_attributes: ContextVar[dict[str, AttributeValue] | None] = ContextVar("session_attributes", default=None)
+
+
+class SessionAttributesSpanProcessor(SpanProcessor):
+    """Stamp the current job's session attributes onto every span it starts."""
+
+    def on_start(self, span: Span, parent_context: Context | None = None) -> None:
+        attributes = _session_attributes.get()
+        if attributes:
+            span.set_attributes(attributes)
+
+
+def _langfuse_otlp_config(
+    host: str | None, public_key: str | None, secret_key: str | None
+) -> tuple[str, dict[str, str]] | None:
+    """Return the OTLP traces endpoint and auth headers for a Langfuse project."""
+    if not public_key or not secret_key or not host:
+        return None
+    langfuse_auth = base64.b64encode(f"{public_key}:{secret_key}".encode()).decode()
+    return f"{host.rstrip('/')}/api/public/otel/v1/traces", {"Authorization": f"Basic {langfuse_auth}"}
+
+
+# Credentials don't change during a worker's lifetime, so resolve them once
+_LANGFUSE_OTLP_CONFIG = _langfuse_otlp_config(
+    os.getenv("LANGFUSE_HOST"), os.getenv("LANGFUSE_PUBLIC_KEY"), os.getenv("LANGFUSE_SECRET_KEY")
+)
 
 
 def setup_langfuse(
-    metadata: dict[str, AttributeValue] | None = None,
     *,
     host: str | None = None,
     public_key: str | None = None,
@@ -38,52 +75,77 @@ def setup_langfuse(
     from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
     from opentelemetry.sdk.trace.export import BatchSpanProcessor
 
-    public_key = public_key or os.getenv("LANGFUSE_PUBLIC_KEY")
-    secret_key = secret_key or os.getenv("LANGFUSE_SECRET_KEY")
-    host = host or os.getenv("LANGFUSE_HOST")
+    if host or public_key or secret_key:
+        otlp_config = _langfuse_otlp_config(
+            host or os.getenv("LANGFUSE_HOST"),
+            public_key or os.getenv("LANGFUSE_PUBLIC_KEY"),
+            secret_key or os.getenv("LANGFUSE_SECRET_KEY"),
+        )
+    else:
+        otlp_config = _LANGFUSE_OTLP_CONFIG
 
-    if not public_key or not secret_key or not host:
+    if otlp_config is None:
         raise ValueError("LANGFUSE_PUBLIC_KEY, LANGFUSE_SECRET_KEY, and LANGFUSE_HOST must be set")
 
-    langfuse_auth = base64.b64encode(f"{public_key}:{secret_key}".encode()).decode()
-    os.environ["OTEL_EXPORTER_OTLP_ENDPOINT"] = f"{host.rstrip('/')}/api/public/otel"
-    os.environ["OTEL_EXPORTER_OTLP_HEADERS"] = f"Authorization=Basic {langfuse_auth}"
+    endpoint, headers = otlp_config
 
     trace_provider = TracerProvider()
-    trace_provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
-    set_tracer_provider(trace_provider, metadata=metadata)
+    trace_provider.add_span_processor(SessionAttributesSpanProcessor())
+    # Langfuse only accepts OTLP over HTTP, so tune the batch queue instead of
+    # switching transports: a deep queue absorbs realtime span bursts and larger
+    # batches mean fewer export round trips.
+    trace_provider.add_span_processor(
+        BatchSpanProcessor(
+            OTLPSpanExporter(endpoint=endpoint, headers=headers),
+            max_queue_size=8192,
+            max_export_batch_size=512,
+            schedule_delay_millis=2000,
+            export_timeout_millis=10000,
+        )
+    )
+    set_tracer_provider(trace_provider)
     return trace_provider
 
 
-def parse_participant_metadata(participant: rtc.RemoteParticipant) -> dict:
+@dataclass
+class ParticipantContext:
+    name: str = "aluno"
+    email: str = ""
+    id: str = ""
+    agent_context: dict | None = None
+
+
+def parse_participant_metadata(participant: rtc.RemoteParticipant) -> ParticipantContext:
     """Parse the participant metadata JSON which contains user, agentContext."""
-    logger.info(f"[METADATA] Participant identity: {participant.identity}")
+    logger.info("[METADATA] Participant identity: %s", participant.identity)
 
     if not participant.metadata:
         logger.warning("[METADATA] No metadata found on participant!")
-        return {}
+        return ParticipantContext()
 
     try:
-        meta = json.loads(participant.metadata)
-        logger.info(f"[METADATA] Parsed metadata keys: {list(meta.keys())}")
-    except (json.JSONDecodeError, TypeError) as e:
-        logger.error(f"[METADATA] Failed to parse metadata as JSON: {e}")
-        return {}
-
-    result = {}
+        meta = orjson.loads(participant.metadata)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("[METADATA] Parsed metadata keys: %s", list(meta))
+    except (orjson.JSONDecodeError, TypeError) as e:
+        logger.error("[METADATA] Failed to parse metadata as JSON: %s", e)
+        return ParticipantContext()
 
     # Extract user info (set by livekit.js from the JWT)
     user = meta.get("user", {})
-    result["name"] = user.get("name", "aluno")
-    result["email"] = user.get("email", "")
-    result["id"] = user.get("id", "")
-    logger.info(f"[METADATA] User: name={result['name']}, email={result['email']}, id={result['id']}")
+    result = ParticipantContext(
+        name=user.get("name", "aluno"),
+        email=user.get("email", ""),
+        id=user.get("id", ""),
+    )
+    logger.info("[METADATA] User: name=%s, email=%s, id=%s", result.name, result.email, result.id)
 
     # Extract agentContext (the full context built by the frontend)
     agent_context = meta.get("agentContext")
     if agent_context:
-        result["agentContext"] = agent_context
-        logger.info(f"[METADATA] agentContext found with keys: {list(agent_context.keys())}")
+        result.agent_context = agent_context
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("[METADATA] agentContext found with keys: %s", list(agent_context))
     else:
         logger.warning("[METADATA] No agentContext in metadata!")
 
@@ -99,6 +161,13 @@ CORREÇÃO ATIVA: Você SEMPRE identifica e corrige erros de pronúncia, gramát
 Estilo: claro, conciso, amigável; evite teoria longa; sempre feche com ação.
 """
 
+STUDENT_NAME_INSTRUCTION = "\n\nO NOME DO ALUNO É: {name}. REGRA OBRIGATÓRIA: Ao iniciar a conversa, SEMPRE cumprimente o aluno pelo nome (ex: \"Olá, {name}!\"). Use o nome dele ao longo da aula também."
+
+
+def personalize_instruction(template: str, user_name: str) -> str:
+    """Fill the student's name into a system instruction."""
+    return template.replace("{userName}", user_name) + STUDENT_NAME_INSTRUCTION.format(name=user_name)
+
 
 class MikeAgent(Agent):
     def __init__(self, instructions: str, initial_message: str = "") -> None:
@@ -112,6 +181,16 @@ class MikeAgent(Agent):
             self.session.generate_reply()
 
 
+def prewarm(proc: JobProcess):
+    logging_setup.configure()
+
+    try:
+        proc.userdata["trace_provider"] = setup_langfuse()
+        logger.info("[PREWARM] Langfuse tracing initialized")
+    except Exception as e:
+        logger.warning("[PREWARM] Langfuse setup failed (continuing without tracing): %s", e)
+
+
 async def entrypoint(ctx: JobContext):
 
     await ctx.connect()
@@ -119,11 +198,26 @@ async def entrypoint(ctx: JobContext):
 
     parsed = parse_participant_metadata(participant)
 
-    user_name = parsed.get("name", "aluno")
-    user_id = parsed.get("id") or user_name
-    user_email = parsed.get("email", "")
-    context = parsed.get("agentContext")
+    user_name = parsed.name
+    user_id = parsed.id or user_name
+    user_email = parsed.email
+    context = parsed.agent_context
+
+    # Tasks spawned by the session inherit this, so all of its spans carry it
+    _session_attributes.set({
+        "langfuse.session.id": ctx.room.name,
+        "langfuse.user.id": user_id,
+        "user.email": user_email,
+    })
+
+    # Job processes exit without running atexit hooks, so flush this session's
+    # spans before the job ends
+    trace_provider = ctx.proc.userdata.get("trace_provider")
+    if trace_provider is not None:
+        async def flush_trace():
+            trace_provider.force_flush()
 
+        ctx.add_shutdown_callback(flush_trace)
 
     if context:
         system_instruction = context.get("systemInstruction", FALLBACK_INSTRUCTION)
@@ -131,37 +225,19 @@ async def entrypoint(ctx: JobContext):
         voice = context.get("voice", "Charon")
         timing_prompts = context.get("timingPrompts", {})
         lesson_duration = context.get("lessonDurationSec", 300)
-        logger.info(f"[ENTRYPOINT] Using frontend context: voice={voice}, instruction={len(system_instruction)} chars")
+        logger.info("[ENTRYPOINT] Using frontend context: voice=%s, instruction=%d chars", voice, len(system_instruction))
     else:
         system_instruction = f"Se apresente como Professor Mike e comece uma aula para {user_name}.\n{FALLBACK_INSTRUCTION}"
         initial_message = ""
         voice = "Charon"
         timing_prompts = {}
         lesson_duration = 300
-        logger.warning(f"[ENTRYPOINT] No agentContext in metadata, using FALLBACK")
+        logger.warning("[ENTRYPOINT] No agentContext in metadata, using FALLBACK")
 
     # Personalize with user name
-    system_instruction = system_instruction.replace("{userName}", user_name)
-    system_instruction += f"\n\nO NOME DO ALUNO É: {user_name}. REGRA OBRIGATÓRIA: Ao iniciar a conversa, SEMPRE cumprimente o aluno pelo nome (ex: \"Olá, {user_name}!\"). Use o nome dele ao longo da aula também."
-
-    try:
-        trace_provider = setup_langfuse(
-            metadata={
-                "langfuse.session.id": ctx.room.name,
-                "langfuse.user.id": user_id,
-                "user.email": user_email,
-            }
-        )
+    system_instruction = personalize_instruction(system_instruction, user_name)
 
-        async def flush_trace():
-            trace_provider.force_flush()
-
-        ctx.add_shutdown_callback(flush_trace)
-        logger.info("[ENTRYPOINT] Langfuse tracing initialized")
-    except Exception as e:
-        logger.warning(f"[ENTRYPOINT] Langfuse setup failed (continuing without tracing): {e}")
-
-    logger.info(f"[ENTRYPOINT] Creating AgentSession with model=gemini-2.5-flash-native-audio-preview-09-2025, voice={voice}")
+    logger.info("[ENTRYPOINT] Creating AgentSession with model=gemini-2.5-flash-native-audio-preview-09-2025, voice=%s", voice)
     session = AgentSession(
         llm=google.realtime.RealtimeModel(
             model="gemini-2.5-flash-native-audio-preview-09-2025",
@@ -174,7 +250,7 @@ async def entrypoint(ctx: JobContext):
     def _on_metrics_collected(ev: MetricsCollectedEvent):
         metrics.log_metrics(ev.metrics)
 
-    logger.info(f"[ENTRYPOINT] Starting agent session...")
+    logger.info("[ENTRYPOINT] Starting agent session...")
     await session.start(
         agent=MikeAgent(
             instructions=system_instruction,
@@ -185,41 +261,56 @@ async def entrypoint(ctx: JobContext):
         ),
         room=ctx.room,
     )
-    logger.info(f"[ENTRYPOINT] Agent session started successfully!")
+    logger.info("[ENTRYPOINT] Agent session started successfully!")
 
     # Schedule timing prompts (pronunciation warning, ending warning)
-    async def send_timing_prompts():
+    def send_timing_prompt(label: str, message: str):
         try:
-            pron_warning = timing_prompts.get("pronunciationWarning", {})
-            end_warning = timing_prompts.get("endingWarning", {})
+            logger.info("[TIMING] Sending %s NOW", label)
+            session.generate_reply(instructions=message)
+        except Exception as e:
+            logger.error("[TIMING] Error: %s: %s", type(e).__name__, e)
 
-            pron_at = pron_warning.get("atSecRemaining", 60)
-            end_at = end_warning.get("atSecRemaining", 10)
+    timing_handles: list[asyncio.TimerHandle] = []
+    try:
+        pron_warning = timing_prompts.get("pronunciationWarning", {})
+        end_warning = timing_prompts.get("endingWarning", {})
 
-            pron_delay = lesson_duration - pron_at
-            end_delay = lesson_duration - end_at
+        pron_at = pron_warning.get("atSecRemaining", 60)
+        end_at = end_warning.get("atSecRemaining", 10)
 
-            logger.info(f"[TIMING] Scheduled: pronunciation warning at {pron_delay}s, ending warning at {end_delay}s (lesson={lesson_duration}s)")
+        pron_delay = lesson_duration - pron_at
+        end_delay = lesson_duration - end_at
 
-            if pron_delay > 0 and pron_warning.get("message"):
-                await asyncio.sleep(pron_delay)
-                logger.info("[TIMING] Sending pronunciation warning NOW")
-                session.generate_reply(instructions=pron_warning["message"])
+        logger.info(
+            "[TIMING] Scheduled: pronunciation warning at %ss, ending warning at %ss (lesson=%ss)",
+            pron_delay, end_delay, lesson_duration,
+        )
 
-            remaining_wait = end_delay - pron_delay
-            if remaining_wait > 0 and end_warning.get("message"):
-                await asyncio.sleep(remaining_wait)
-                logger.info("[TIMING] Sending ending warning NOW")
-                session.generate_reply(instructions=end_warning["message"])
+        # Absolute deadlines on the loop's own timer heap: no coroutine is kept
+        # alive for the whole lesson, and one prompt can't delay the other
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
 
-            logger.info("[TIMING] All timing prompts sent")
-        except asyncio.CancelledError:
-            logger.info("[TIMING] Timing prompts cancelled (session ended)")
-        except Exception as e:
-            logger.error(f"[TIMING] Error: {type(e).__name__}: {e}")
+        if pron_delay > 0 and pron_warning.get("message"):
+            timing_handles.append(loop.call_at(
+                started_at + pron_delay, send_timing_prompt, "pronunciation warning", pron_warning["message"]
+            ))
+
+        if end_delay > 0 and end_warning.get("message"):
+            timing_handles.append(loop.call_at(
+                started_at + end_delay, send_timing_prompt, "ending warning", end_warning["message"]
+            ))
+    except Exception as e:
+        logger.error("[TIMING] Error: %s: %s", type(e).__name__, e)
+
+    async def cancel_timing_prompts():
+        for handle in timing_handles:
+            handle.cancel()
+        logger.info("[TIMING] Timing prompts cancelled (session ended)")
 
-    asyncio.create_task(send_timing_prompts())
+    ctx.add_shutdown_callback(cancel_timing_prompts)
 
 
 if __name__ == "__main__":
-    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint))
+    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint, prewarm_fnc=prewarm))